@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
 """
 RPLIDAR A1 Real-time Visualization Program
-360-degree distance data display with matplotlib
+360-degree distance data display with pyqtgraph
 Note: Check /dev/tty.* with 'ls /dev/tty.*' command to find your device
 """
 
 import serial
+import signal
 import struct
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtCore, QtWidgets
 import time
 
 # ==================== CONFIGURATION ====================
@@ -21,14 +22,13 @@ BAUDRATE = 115200
 
 # Visualization parameters
 UPDATE_RATE = 50  # milliseconds (20 fps)
-POINT_SIZE = 1  # size of data points
+POINT_SIZE = 3  # size of data points in pixels
 MAX_DISTANCE = 5000  # maximum distance in mm
 ANGLE_RESOLUTION = 0.5  # degrees (0.5 = 720 points, 1.0 = 360 points)
-DATA_COLLECTION_TIME = 0.1  # seconds per frame
 
 # Color map settings
-COLORMAP = 'jet'  # 'jet' provides blue(near) to red(far) gradient
-# Other options: 'viridis', 'plasma', 'turbo', 'rainbow'
+COLORMAP = 'turbo'  # 'turbo' provides blue(near) to red(far) gradient
+# Other options: 'viridis', 'plasma', 'inferno', 'magma'
 
 # Angle adjustment
 MIRROR_HORIZONTALLY = False  # Set to True to swap left/right (90° ↔ 270°)
@@ -37,6 +37,18 @@ MIRROR_HORIZONTALLY = False  # Set to True to swap left/right (90° ↔ 270°)
 
 # ======================================================
 
+# Polar angle (radians) of each angle bin, with the horizontal mirror applied
+_bin_degrees = np.arange(int(360 / ANGLE_RESOLUTION)) * ANGLE_RESOLUTION
+if MIRROR_HORIZONTALLY:
+    # Mirror the angle horizontally (left-right flip)
+    # This swaps 90° and 270°
+    _bin_degrees = (360 - _bin_degrees) % 360
+ANGLE_RAD_LUT = np.radians(_bin_degrees)
+# Screen direction of each angle bin: 0 degrees at top, clockwise
+BIN_X_LUT = np.sin(ANGLE_RAD_LUT)
+BIN_Y_LUT = np.cos(ANGLE_RAD_LUT)
+
+
 class RPLidarA1:
     """Simple driver for RPLIDAR A1"""
 
@@ -54,11 +66,16 @@ class RPLidarA1:
     INFO_LEN = 20
     HEALTH_LEN = 3
 
-    def __init__(self, port, baudrate=115200, timeout=1):
+    STOP_DRAIN_TIMEOUT = 0.2  # Upper bound on draining after STOP (seconds)
+    STOP_QUIET_TIME = 0.02  # Line must stay quiet this long to count as stopped (seconds)
+
+    def __init__(self, port, baudrate=115200, timeout=1, scan_timeout=0.005):
         self.port = port
         self.baudrate = baudrate
-        self.timeout = timeout
+        self.timeout = timeout  # Read timeout for command responses
+        self.scan_timeout = scan_timeout  # Read timeout while streaming scan data
         self.serial = None
+        self._buffer = bytearray()  # Holds a trailing partial packet between reads
 
     def connect(self):
         """Connect to serial port"""
@@ -70,6 +87,11 @@ class RPLidarA1:
             stopbits=serial.STOPBITS_ONE,
             bytesize=serial.EIGHTBITS
         )
+        # Drop the FTDI latency timer from 16 ms to 1 ms where the driver supports it
+        try:
+            self.serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, IOError, ValueError):
+            pass  # Not available on this platform/driver
 
     def disconnect(self):
         """Close connection"""
@@ -122,41 +144,59 @@ class RPLidarA1:
         # Check scan response header
         if descriptor[0] != self.SYNC_BYTE or descriptor[1] != self.SYNC_BYTE2:
             raise Exception("Failed to start scan")
+        # Keep reads from blocking the frame loop while streaming
+        self.serial.timeout = self.scan_timeout
 
     def stop_scan(self):
         """Stop scanning"""
         self._send_command(self.STOP)
-        time.sleep(0.1)  # Wait for command processing
+        # Drain data still in flight until the line stays quiet
+        now = time.monotonic()
+        deadline = now + self.STOP_DRAIN_TIMEOUT
+        quiet_until = now + self.STOP_QUIET_TIME
+        while time.monotonic() < min(deadline, quiet_until):
+            waiting = self.serial.in_waiting
+            if waiting:
+                self.serial.read(waiting)
+                quiet_until = time.monotonic() + self.STOP_QUIET_TIME
+            else:
+                time.sleep(0.005)
         self.serial.reset_input_buffer()
+        self._buffer.clear()
+        self.serial.timeout = self.timeout
 
     def reset(self):
         """Reset device"""
         self._send_command(self.RESET)
         time.sleep(2)  # Wait for reset completion
 
-    def read_scan_data(self):
-        """Read scan data (generator)"""
-        while True:
-            # Read 5-byte data point
-            data = self.serial.read(5)
-            if len(data) == 5:
-                # Parse data
-                quality = data[0] >> 2
-                start_flag = (data[0] & 0x01) == 1
-                # Calculate angle (fixed point format)
-                angle = ((data[2] << 8) | data[1]) >> 1
-                angle = angle / 64.0  # Convert to degrees
-                # Calculate distance
-                distance = (data[4] << 8) | data[3]
-                distance = distance / 4.0  # Convert to mm
-
-                if quality > 0 and distance > 0:
-                    yield {
-                        'angle': angle,
-                        'distance': distance,
-                        'quality': quality,
-                        'start_flag': start_flag
-                    }
+    def read_packets(self):
+        """Read all pending bytes at once and return the complete 5-byte packets"""
+        self._buffer += self.serial.read(max(5, self.serial.in_waiting))
+        # Keep any trailing partial packet for the next read
+        size = len(self._buffer) - len(self._buffer) % 5
+        packets = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return packets
+
+    @staticmethod
+    def parse_packets(buf):
+        """Parse 5-byte packets into (quality, angle, distance, start_count, total_starts)
+
+        start_count is the number of start flags seen up to each point, counted
+        before invalid points are dropped so no revolution start is lost.
+        """
+        packets = np.frombuffer(buf, dtype=np.uint8).reshape(-1, 5)
+        quality = packets[:, 0] >> 2
+        start_count = np.cumsum(packets[:, 0] & 0x01, dtype=np.int64)
+        total_starts = int(start_count[-1]) if len(start_count) else 0
+        # Calculate angle (fixed point format) in degrees
+        angle = (((packets[:, 2].astype(np.uint16) << 8) | packets[:, 1]) >> 1) * (1.0 / 64.0)
+        # Calculate distance in mm
+        distance = ((packets[:, 4].astype(np.uint16) << 8) | packets[:, 3]).astype(np.float32) * 0.25
+
+        mask = (quality > 0) & (distance > 0)
+        return quality[mask], angle[mask], distance[mask], start_count[mask], total_starts
 
 
 class LidarVisualizer:
@@ -164,98 +204,145 @@ class LidarVisualizer:
 
     def __init__(self, lidar):
         self.lidar = lidar
-        self.angles = []
-        self.distances = []
         self.max_points = int(360 / ANGLE_RESOLUTION)  # Calculate based on resolution
 
-        # Plot setup
-        self.fig = plt.figure(figsize=(10, 10))
-        self.ax = self.fig.add_subplot(111, projection='polar')
-        self.ax.set_ylim(0, MAX_DISTANCE)
-        self.ax.set_title('RPLIDAR A1 - 360° Distance Data', fontsize=16)
-        self.ax.grid(True)
+        # Latest distance per angle bin, kept across frames and expired by revolution
+        self._bin_distances = np.full(self.max_points, np.nan)
+        self._bin_revolution = np.zeros(self.max_points, dtype=np.int64)
+        self._revolution = 0
+
+        # Per-frame buffers, reused and updated in place every frame
+        self._x = np.zeros(self.max_points)
+        self._y = np.zeros(self.max_points)
+        self._c = np.zeros(self.max_points)
 
-        # Set angle direction and zero location
-        self.ax.set_theta_direction(-1)  # Clockwise
-        self.ax.set_theta_zero_location('N')  # 0 degrees at top
+        # Plot setup
+        pg.setConfigOptions(background='w', foreground='k')
+        self.app = pg.mkQApp('RPLIDAR A1')
+        self.win = pg.GraphicsLayoutWidget(title='RPLIDAR A1 - 360° Distance Data')
+        self.win.resize(1000, 1000)
+        self.plot = self.win.addPlot(title='RPLIDAR A1 - 360° Distance Data')
+        self.plot.setAspectLocked(True)
+        self.plot.hideAxis('left')
+        self.plot.hideAxis('bottom')
+        self.plot.setRange(xRange=(-MAX_DISTANCE, MAX_DISTANCE), yRange=(-MAX_DISTANCE, MAX_DISTANCE))
+        self._draw_polar_grid()
 
         # Initialize scatter plot with distance-based coloring
-        self.scatter = self.ax.scatter([], [], c=[], cmap=COLORMAP,
-                                      s=POINT_SIZE, vmin=0, vmax=MAX_DISTANCE)
+        self.scatter = pg.ScatterPlotItem(size=POINT_SIZE, pen=None)
+        self.plot.addItem(self.scatter)
+
+        # One brush per colormap step, picked by distance each frame
+        self.cmap = pg.colormap.get(COLORMAP)
+        self._brushes = np.array([pg.mkBrush(color) for color in
+                                  self.cmap.map(np.linspace(0, 1, 256), mode='qcolor')], dtype=object)
 
         # Initialize colorbar
-        self.cbar = plt.colorbar(self.scatter, ax=self.ax, pad=0.1)
-        self.cbar.set_label('Distance (mm)', rotation=270, labelpad=20)
+        self.cbar = pg.ColorBarItem(values=(0, MAX_DISTANCE), colorMap=self.cmap,
+                                    label='Distance (mm)', interactive=False)
+        self.win.addItem(self.cbar)
 
         # Initialize text display
-        self.text = self.ax.text(0.02, 0.98, '', transform=self.ax.transAxes,
-                                verticalalignment='top', fontsize=10,
-                                bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
-
-    def update(self, frame):
-        """Animation update function"""
-        # Collect new data
-        angle_dict = {}  # Use dict to handle angle resolution
-
-        start_time = time.time()
-        point_count = 0
-
-        # Collect data for specified time
-        while time.time() - start_time < DATA_COLLECTION_TIME:
-            try:
-                data = next(self.lidar.read_scan_data())
-                # Round angle to nearest resolution step
-                angle_key = round(data['angle'] / ANGLE_RESOLUTION) * ANGLE_RESOLUTION
-                angle_dict[angle_key] = data['distance']
-                point_count += 1
-            except StopIteration:
-                break
-
-        if angle_dict:
-            # Convert to lists
-            angles = []
-            distances = []
-            for angle, distance in angle_dict.items():
-                # Apply angle adjustment if needed
-                if MIRROR_HORIZONTALLY:
-                    # Mirror the angle horizontally (left-right flip)
-                    # This swaps 90° and 270°
-                    adjusted_angle = (360 - angle) % 360
-                else:
-                    adjusted_angle = angle
-
-                angles.append(np.radians(adjusted_angle))
-                distances.append(distance)
-
-            # Update data
-            self.angles = angles
-            self.distances = distances
-
-            # Update scatter plot
-            self.scatter.set_offsets(np.c_[angles, distances])
-            self.scatter.set_array(np.array(distances))  # Color by distance
+        self.text = pg.TextItem('', color='k', fill=pg.mkBrush(255, 255, 255, 200), anchor=(0, 0))
+        self.text.setPos(-MAX_DISTANCE, MAX_DISTANCE)
+        self.plot.addItem(self.text, ignoreBounds=True)
+
+        # Statistics text template with the constant parts filled in once
+        self._info_tmpl = ('Points: %%d/%d\n'
+                           'Avg Distance: %%.0f mm\n'
+                           'Min Distance: %%.0f mm\n'
+                           'Max Distance: %%.0f mm\n'
+                           'Update Rate: %.1f Hz') % (self.max_points, 1000 / UPDATE_RATE)
+
+    def _draw_polar_grid(self):
+        """Draw range rings and angle spokes for the polar view"""
+        grid_pen = pg.mkPen(color=(200, 200, 200))
+
+        # Range rings every 1000 mm
+        for radius in range(1000, MAX_DISTANCE + 1, 1000):
+            ring = QtWidgets.QGraphicsEllipseItem(-radius, -radius, 2 * radius, 2 * radius)
+            ring.setPen(grid_pen)
+            self.plot.addItem(ring)
+
+        # Angle spokes every 30 degrees, labelled with the sensor angle
+        for angle in range(0, 360, 30):
+            display_angle = (360 - angle) % 360 if MIRROR_HORIZONTALLY else angle
+            x = np.sin(np.radians(display_angle)) * MAX_DISTANCE
+            y = np.cos(np.radians(display_angle)) * MAX_DISTANCE
+            self.plot.plot([0, x], [0, y], pen=grid_pen)
+            label = pg.TextItem(f'{angle}°', color='k', anchor=(0.5, 0.5))
+            label.setPos(x * 1.06, y * 1.06)
+            self.plot.addItem(label)
+
+    def update(self):
+        """Timer update function"""
+        # An exception escaping a Qt slot aborts the process, so stop the event
+        # loop instead and let start() re-raise it for main() to clean up
+        try:
+            self._update_frame()
+        except (Exception, KeyboardInterrupt) as e:
+            self._stop(e)
+
+    def _stop(self, error=None):
+        """Stop the timer and quit the event loop, remembering why"""
+        self._error = error
+        self.timer.stop()
+        self.app.quit()
+
+    def _update_frame(self):
+        """Read new packets and redraw the scatter plot"""
+        bin_distances = self._bin_distances
+
+        # Drain everything received since the last frame in a single read
+        _, new_angles, new_distances, start_count, total_starts = self.lidar.parse_packets(
+            self.lidar.read_packets())
+        # Revolution each point belongs to (a start flag begins a new one)
+        revolutions = self._revolution + start_count
+        # Round angle to nearest resolution step (later points overwrite earlier ones)
+        bins = np.rint(new_angles * (1.0 / ANGLE_RESOLUTION)).astype(np.int32) % self.max_points
+        bin_distances[bins] = new_distances
+        self._bin_revolution[bins] = revolutions
+        self._revolution += total_starts
+
+        # Show bins updated during the current or previous revolution
+        valid = ~np.isnan(bin_distances) & (self._bin_revolution >= self._revolution - 1)
+        n = np.count_nonzero(valid)
+        if n:
+            self._c[:n] = bin_distances[valid]
+            distances = self._c[:n]
+            x = np.multiply(distances, BIN_X_LUT[valid], out=self._x[:n])
+            y = np.multiply(distances, BIN_Y_LUT[valid], out=self._y[:n])
+
+            # Update scatter plot, colored by distance
+            color_idx = np.clip(distances * (255.0 / MAX_DISTANCE), 0, 255).astype(np.intp)
+            self.scatter.setData(x=x, y=y, brush=self._brushes[color_idx])
 
             # Update statistics
-            avg_dist = np.mean(distances) if distances else 0
-            min_dist = np.min(distances) if distances else 0
-            max_dist = np.max(distances) if distances else 0
-
-            info_text = f'Points: {len(angles)}/{self.max_points}\n'
-            info_text += f'Avg Distance: {avg_dist:.0f} mm\n'
-            info_text += f'Min Distance: {min_dist:.0f} mm\n'
-            info_text += f'Max Distance: {max_dist:.0f} mm\n'
-            info_text += f'Update Rate: {1000/UPDATE_RATE:.1f} Hz'
-            self.text.set_text(info_text)
+            avg_dist = np.mean(distances)
+            min_dist = np.min(distances)
+            max_dist = np.max(distances)
 
-        return self.scatter, self.text
+            self.text.setText(self._info_tmpl % (n, avg_dist, min_dist, max_dist))
+        else:
+            # Every bin has expired: clear the plot instead of freezing the last frame
+            self.scatter.setData(x=[], y=[])
+            self.text.setText(self._info_tmpl % (0, 0, 0, 0))
 
     def start(self):
         """Start visualization"""
-        # Start animation
-        ani = FuncAnimation(self.fig, self.update, interval=UPDATE_RATE,
-                           blit=True, cache_frame_data=False)
-        plt.show()
-        return ani
+        self._error = None
+        # Ctrl+C quits the event loop (the timer lets Python run the handler)
+        signal.signal(signal.SIGINT, lambda *args: self._stop(KeyboardInterrupt()))
+
+        # Start update timer
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update)
+        self.timer.start(UPDATE_RATE)
+        self.win.show()
+        pg.exec()
+
+        if self._error is not None:
+            raise self._error
 
 
 def main():
@@ -301,7 +388,7 @@ def main():
         print("Opening visualization window...")
         print("Close the window to exit")
         visualizer = LidarVisualizer(lidar)
-        ani = visualizer.start()
+        visualizer.start()
 
     except KeyboardInterrupt:
         print("\nShutting down...")
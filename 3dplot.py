@@ -2,17 +2,19 @@
 """
 RPLIDAR A1 3Dインタラクティブ可視化プログラム（修正版）
 Plotly Dashを使用してマウスで視点を変更可能な3D表示
+（プロット点数が少ない場合は上から見た2D表示をWebGLで高速描画）
 """
 
 import serial
 import struct
 import numpy as np
 import plotly.graph_objects as go
-from dash import Dash, dcc, html, State
+from numba import njit
+from dash import Dash, dcc, html, State, Patch, no_update, ctx
 from dash.dependencies import Input, Output
 import time
+import queue
 from threading import Thread, Lock
-import collections
 
 class RPLidarA1:
     """RPLIDAR A1用の簡易ドライバ"""
@@ -30,11 +32,16 @@ class RPLidarA1:
     INFO_LEN = 20
     HEALTH_LEN = 3
 
-    def __init__(self, port, baudrate=115200, timeout=1):
+    STOP_DRAIN_TIMEOUT = 0.2  # 停止後に受信データを読み捨てる最大時間（秒）
+    STOP_QUIET_TIME = 0.02  # この時間受信がなければ停止完了とみなす（秒）
+
+    def __init__(self, port, baudrate=115200, timeout=1, scan_timeout=0.005):
         self.port = port
         self.baudrate = baudrate
-        self.timeout = timeout
+        self.timeout = timeout  # コマンド応答の読み取りタイムアウト
+        self.scan_timeout = scan_timeout  # スキャン中の読み取りタイムアウト
         self.serial = None
+        self._buffer = bytearray()  # 読み残した不完全なパケットを保持
 
     def connect(self):
         """シリアルポートに接続"""
@@ -46,6 +53,11 @@ class RPLidarA1:
             stopbits=serial.STOPBITS_ONE,
             bytesize=serial.EIGHTBITS
         )
+        # 対応ドライバではFTDIのレイテンシタイマを16msから1msに短縮
+        try:
+            self.serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, IOError, ValueError):
+            pass  # このプラットフォーム/ドライバでは非対応
 
     def disconnect(self):
         """接続を閉じる"""
@@ -86,37 +98,102 @@ class RPLidarA1:
         descriptor = self._read_descriptor()
         if descriptor[0] != self.SYNC_BYTE or descriptor[1] != self.SYNC_BYTE2:
             raise Exception("スキャン開始に失敗")
+        # スキャン中は読み取りで長時間ブロックしないようにする
+        self.serial.timeout = self.scan_timeout
 
     def stop_scan(self):
         """スキャンを停止"""
         self._send_command(self.STOP)
-        time.sleep(0.1)
+        # 送信途中のデータを受信が途切れるまで読み捨てる
+        now = time.monotonic()
+        deadline = now + self.STOP_DRAIN_TIMEOUT
+        quiet_until = now + self.STOP_QUIET_TIME
+        while time.monotonic() < min(deadline, quiet_until):
+            waiting = self.serial.in_waiting
+            if waiting:
+                self.serial.read(waiting)
+                quiet_until = time.monotonic() + self.STOP_QUIET_TIME
+            else:
+                time.sleep(0.005)
         self.serial.reset_input_buffer()
-
-    def read_scan_data(self):
-        """スキャンデータを読み取り（ジェネレータ）"""
-        while True:
-            data = self.serial.read(5)
-            if len(data) == 5:
-                quality = data[0] >> 2
-                angle = ((data[2] << 8) | data[1]) >> 1
-                angle = angle / 64.0  # 度に変換
-                distance = (data[4] << 8) | data[3]
-                distance = distance / 4.0  # mmに変換
-
-                if quality > 0 and distance > 0:
-                    yield {
-                        'angle': angle,
-                        'distance': distance,
-                        'quality': quality
-                    }
-
+        self._buffer.clear()
+        self.serial.timeout = self.timeout
+
+    def read_packets(self):
+        """受信済みのバイト列をまとめて読み取り、完全な5バイトパケットを返す"""
+        self._buffer += self.serial.read(max(5, self.serial.in_waiting))
+        # 末尾の不完全なパケットは次回の読み取りに回す
+        size = len(self._buffer) - len(self._buffer) % 5
+        packets = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return packets
+
+
+# 角度解像度（度）と極座標→直交座標変換用のテーブル（毎フレームの三角関数計算を省略）
+ANGLE_RESOLUTION = 0.25  # プロット点数スライダーの最大値（1440点）に合わせる
+NUM_ANGLE_BINS = int(360 / ANGLE_RESOLUTION)
+_angle_bins_rad = np.radians(np.arange(NUM_ANGLE_BINS) * ANGLE_RESOLUTION)
+COS_LUT = np.cos(_angle_bins_rad).astype(np.float32)
+SIN_LUT = np.sin(_angle_bins_rad).astype(np.float32)
+ANGLE_RES_Q6 = int(ANGLE_RESOLUTION * 64)  # 角度ビン幅（1/64度単位の固定小数点）
+
+@njit(nogil=True, cache=True)
+def parse_to_bins(buf, out_bins, out_distances, out_starts):
+    """5バイトパケット列を解析し、角度ビン・距離・スタートフラグ数を書き込む（GIL解放）
+
+    無効な点についたスタートフラグも失わないよう、次の有効な点までの回転開始数を
+    out_starts に数える。戻り値は (有効な点数, 最後の有効な点より後の回転開始数)。
+    """
+    n = 0
+    pending_starts = 0
+    for i in range(0, buf.shape[0] - 4, 5):
+        # 回転の開始は点の有効・無効に関わらず数える
+        pending_starts += buf[i] & 0x01
+        quality = buf[i] >> 2
+        distance = ((int(buf[i + 4]) << 8) | buf[i + 3]) * 0.25  # mmに変換
+        if quality == 0 or distance == 0:
+            continue
+        # 固定小数点の角度から直接、最も近い角度ビンを求める
+        angle_q6 = ((int(buf[i + 2]) << 8) | buf[i + 1]) >> 1
+        out_bins[n] = ((angle_q6 + ANGLE_RES_Q6 // 2) // ANGLE_RES_Q6) % NUM_ANGLE_BINS
+        out_distances[n] = distance
+        out_starts[n] = pending_starts
+        pending_starts = 0
+        n += 1
+    return n, pending_starts
+
+@njit(nogil=True, cache=True)
+def merge_bins(bins, distances, starts, dist_by_bin, bin_revolution, revolution):
+    """角度ビンごとに最新の1回転で最も近い点を残し、更新後の回転番号を返す"""
+    for i in range(bins.shape[0]):
+        revolution += starts[i]
+        b = bins[i]
+        if bin_revolution[b] != revolution or distances[i] < dist_by_bin[b]:
+            dist_by_bin[b] = distances[i]
+            bin_revolution[b] = revolution
+    return revolution
+
+def select_bins(dist_by_bin, max_points):
+    """角度ビンを max_points 個の扇形にまとめ、各扇形で最も近い点のビン番号を返す"""
+    if max_points >= NUM_ANGLE_BINS:
+        return np.flatnonzero(np.isfinite(dist_by_bin))
+    sectors = np.arange(NUM_ANGLE_BINS) * max_points // NUM_ANGLE_BINS
+    # 扇形ごとに距離の昇順に並べ、先頭（最も近い点）を採用
+    order = np.lexsort((dist_by_bin, sectors))
+    first = np.ones(NUM_ANGLE_BINS, dtype=bool)
+    first[1:] = sectors[order[1:]] != sectors[order[:-1]]
+    selected = order[first]
+    return selected[np.isfinite(dist_by_bin[selected])]
 
 # グローバル変数（データ共有用）
+BATCH_PACKETS = 256  # scan_workerがまとめて解析・送信するパケット数
+SCAN_QUEUE_SIZE = 64  # 未反映のバッチをこれ以上溜めない（古いものから捨てる）
+scan_queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)  # scan_worker → update_graph へのバッチ受け渡し
 lidar_data = {
-    'angles': collections.deque(maxlen=1800),  # 最大1800点（半分に削減）
-    'distances': collections.deque(maxlen=1800),
-    'qualities': collections.deque(maxlen=1800)
+    'dist_by_bin': np.full(NUM_ANGLE_BINS, np.inf, dtype=np.float32),  # 角度ビンごとの距離（未取得はinf）
+    'bin_revolution': np.zeros(NUM_ANGLE_BINS, dtype=np.int64),  # 各ビンを最後に更新した回転番号
+    'revolution': 0,
+    'version': 0  # 新しいデータを反映するたびに増加
 }
 data_lock = Lock()
 lidar_instance = None
@@ -124,18 +201,125 @@ scan_thread = None
 running = True
 
 def scan_worker():
-    """別スレッドでスキャンデータを読み取る"""
+    """別スレッドでスキャンデータを読み取り、解析済みのバッチをキューに送る"""
     global running
+    pending = bytearray()
     while running:
         try:
-            data = next(lidar_instance.read_scan_data())
-            with data_lock:
-                lidar_data['angles'].append(data['angle'])
-                lidar_data['distances'].append(data['distance'])
-                lidar_data['qualities'].append(data['quality'])
+            pending += lidar_instance.read_packets()
+            if len(pending) < BATCH_PACKETS * 5:
+                continue
+            buf = np.frombuffer(bytes(pending), dtype=np.uint8)
+            pending.clear()
+            size = len(buf) // 5
+            bins = np.empty(size, dtype=np.int32)
+            distances = np.empty(size, dtype=np.float32)
+            starts = np.empty(size, dtype=np.int64)
+            n, trailing_starts = parse_to_bins(buf, bins, distances, starts)
+            batch = (bins[:n], distances[:n], starts[:n], trailing_starts)
+            try:
+                scan_queue.put_nowait(batch)
+            except queue.Full:
+                # 画面が更新されていない間は古いバッチから捨てる
+                try:
+                    scan_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                scan_queue.put_nowait(batch)
         except:
             break
 
+def drain_scan_queue():
+    """キューに溜まったバッチを角度ビンに反映する（data_lockを保持して呼ぶこと）"""
+    merged = False
+    while True:
+        try:
+            bins, distances, starts, trailing_starts = scan_queue.get_nowait()
+        except queue.Empty:
+            break
+        lidar_data['revolution'] = merge_bins(
+            bins, distances, starts, lidar_data['dist_by_bin'],
+            lidar_data['bin_revolution'], lidar_data['revolution']) + trailing_starts
+        # 有効な点がなくても回転が進めば古いビンが期限切れになるので再描画する
+        merged = merged or len(bins) > 0 or trailing_starts > 0
+    if merged:
+        lidar_data['version'] += 1
+
+DEFAULT_MAX_POINTS = 720  # プロット点数の初期値
+GL_MAX_POINTS = 720  # この点数以下では上から見た2D表示（WebGL）を使用
+
+def create_figure(use_gl):
+    """グラフを作成（以降の更新は点群データのみを差分送信）
+
+    use_gl=True の場合は上から見下ろした2D表示をWebGL（Scattergl）で描画し、
+    False の場合はマウスで回転できる3D表示（Scatter3d）を作成する。
+    """
+    fig = go.Figure()
+    marker = dict(
+        size=2 if use_gl else 1,  # 点を小さく
+        color=[],  # 距離で色分け
+        colorscale='Turbo',  # 見やすいカラースケール
+        colorbar=dict(title="距離 (mm)"),
+        showscale=True,
+        cmin=0,
+        cmax=5000
+    )
+
+    if use_gl:
+        # LiDARデータの点群
+        fig.add_trace(go.Scattergl(x=[], y=[], mode='markers', name='LiDARデータ', marker=marker))
+
+        # 中心点（LiDAR位置）を追加
+        fig.add_trace(go.Scattergl(
+            x=[0], y=[0],
+            mode='markers',
+            name='中心',
+            marker=dict(size=4, color='black'),
+            showlegend=False
+        ))
+
+        fig.update_layout(
+            xaxis=dict(title="X (mm)", range=[-5000, 5000]),
+            yaxis=dict(title="Y (mm)", range=[-5000, 5000], scaleanchor='x'),  # 縦横比を1:1に固定
+            plot_bgcolor='white',
+            margin=dict(l=0, r=0, t=0, b=0),
+            uirevision='constant',  # UIの状態（ズーム位置など）を保持
+            showlegend=False  # 凡例を非表示
+        )
+        return fig
+
+    # LiDARデータの点群
+    # Z軸は0（2D LiDARなので高さ情報なし）。Plotlyは最短の配列長に合わせて描画するため、
+    # 最大点数分の z を作成時に一度だけ送り、以降の差分更新では x, y のみを送る
+    fig.add_trace(go.Scatter3d(x=[], y=[], z=[0] * NUM_ANGLE_BINS, mode='markers', name='LiDARデータ',
+                               marker=marker))
+
+    # 中心点（LiDAR位置）を追加
+    fig.add_trace(go.Scatter3d(
+        x=[0], y=[0], z=[0],
+        mode='markers',
+        name='中心',
+        marker=dict(
+            size=1,
+            color='black'
+        ),
+        showlegend=False
+    ))
+
+    fig.update_layout(
+        scene=dict(
+            xaxis=dict(title="X (mm)", range=[-5000, 5000]),
+            yaxis=dict(title="Y (mm)", range=[-5000, 5000]),
+            zaxis=dict(title="Z (mm)", range=[-100, 100]),
+            camera=dict(eye=dict(x=0.5, y=0.5, z=2.5)),  # デフォルトは上から見下ろすビュー
+            dragmode='orbit'  # ドラッグモードを明示的に設定
+        ),
+        margin=dict(l=0, r=0, t=0, b=0),
+        uirevision='constant',  # UIの状態（カメラ位置など）を保持
+        showlegend=False  # 凡例を非表示
+    )
+    return fig
+
 # Dashアプリケーションの作成
 app = Dash(__name__)
 
@@ -165,7 +349,7 @@ app.layout = html.Div([
                     min=180,
                     max=1440,
                     step=180,
-                    value=720,
+                    value=DEFAULT_MAX_POINTS,
                     marks={i: str(i) for i in range(180, 1441, 360)},
                     tooltip={"placement": "bottom", "always_visible": True}
                 )
@@ -188,14 +372,17 @@ app.layout = html.Div([
         # 右側：グラフ
         html.Div([
             html.H1('RPLIDAR A1 - 3Dリアルタイム可視化', style={'textAlign': 'center', 'marginBottom': '10px'}),
-            dcc.Graph(id='3d-scatter', style={'height': 'calc(100vh - 80px)'})
+            dcc.Graph(id='3d-scatter', figure=create_figure(DEFAULT_MAX_POINTS <= GL_MAX_POINTS), style={'height': 'calc(100vh - 80px)'})
         ], style={'marginLeft': '250px', 'padding': '10px'})
     ]),
 
     dcc.Interval(id='interval-component', interval=500, n_intervals=0),
 
     # 隠しDiv（停止状態を保持）
-    html.Div(id='stopped-state', style={'display': 'none'}, children='false')
+    html.Div(id='stopped-state', style={'display': 'none'}, children='false'),
+
+    # 隠しDiv（最後に描画したデータのバージョンを保持）
+    html.Div(id='data-version', style={'display': 'none'}, children=-1)
 ])
 
 # 更新レート変更のコールバック
@@ -236,102 +423,61 @@ def toggle_stop(n_clicks, stopped):
 
 # メイングラフ更新のコールバック
 @app.callback(
-    [Output('3d-scatter', 'figure'), Output('stats', 'children')],
+    [Output('3d-scatter', 'figure'), Output('stats', 'children'), Output('data-version', 'children')],
     [Input('interval-component', 'n_intervals'), Input('points-slider', 'value')],
-    [State('3d-scatter', 'figure'), State('stopped-state', 'children'),
-     State('3d-scatter', 'relayoutData')]
+    [State('stopped-state', 'children'), State('data-version', 'children')]
 )
-def update_graph(n, max_points, current_figure, stopped, relayout_data):
+def update_graph(n, max_points, stopped, last_version):
     """グラフを更新"""
-    # 停止中の場合は更新しない
-    if stopped == 'true':
-        return current_figure or go.Figure(), "データ取得停止中"
+    slider_changed = ctx.triggered_id == 'points-slider'
 
+    # 受信済みのバッチを反映（停止中もキューが溢れないよう取り込む）
     with data_lock:
-        if len(lidar_data['angles']) == 0:
-            # データがない場合は空のグラフを返す
-            fig = go.Figure(data=[go.Scatter3d(x=[], y=[], z=[])])
-        else:
-            # データをコピー
-            angles = list(lidar_data['angles'])
-            distances = list(lidar_data['distances'])
-            qualities = list(lidar_data['qualities'])
-
-            # データを間引き（UIで設定された点数に基づく）
-            step = max(1, len(angles) // max_points)
-            angles = angles[::step]
-            distances = distances[::step]
-            qualities = qualities[::step]
-
-            # 3D座標に変換
-            angles_rad = np.radians(angles)
-            x = distances * np.cos(angles_rad)
-            y = distances * np.sin(angles_rad)
-            # Z軸は0（2D LiDARなので高さ情報なし）
-            z = np.zeros_like(angles)
-
-            # 3Dプロット作成
-            fig = go.Figure()
-
-            # LiDARデータの点群
-            fig.add_trace(go.Scatter3d(
-                x=x, y=y, z=z,
-                mode='markers',
-                name='LiDARデータ',
-                marker=dict(
-                    size=1,  # 点を小さく
-                    color=distances,  # 距離で色分け
-                    colorscale='Turbo',  # 見やすいカラースケール
-                    colorbar=dict(title="距離 (mm)"),
-                    showscale=True,
-                    cmin=0,
-                    cmax=5000
-                )
-            ))
-
-            # 中心点（LiDAR位置）を追加
-            fig.add_trace(go.Scatter3d(
-                x=[0], y=[0], z=[0],
-                mode='markers',
-                name='中心',
-                marker=dict(
-                    size=1,
-                    color='black'
-                ),
-                showlegend=False
-            ))
-
-    # レイアウト設定（カメラ位置を保持）
-    camera = dict(eye=dict(x=0.5, y=0.5, z=2.5))  # デフォルトは上から見下ろすビュー
-
-    # relayoutDataから最新のカメラ位置を取得
-    if relayout_data and 'scene.camera' in relayout_data:
-        camera = relayout_data['scene.camera']
-    # 既存のfigureからカメラ位置を取得（relayoutDataがない場合）
-    elif current_figure and 'layout' in current_figure and 'scene' in current_figure['layout']:
-        if 'camera' in current_figure['layout']['scene']:
-            camera = current_figure['layout']['scene']['camera']
+        drain_scan_queue()
 
-    fig.update_layout(
-        scene=dict(
-            xaxis=dict(title="X (mm)", range=[-5000, 5000]),
-            yaxis=dict(title="Y (mm)", range=[-5000, 5000]),
-            zaxis=dict(title="Z (mm)", range=[-100, 100]),
-            camera=camera,
-            dragmode='orbit'  # ドラッグモードを明示的に設定
-        ),
-        margin=dict(l=0, r=0, t=0, b=0),
-        uirevision='constant',  # UIの状態を保持
-        showlegend=False  # 凡例を非表示
-    )
+    # 停止中の場合は更新しない（表示方式が変わる点数変更時のみグラフを作り直す）
+    if stopped == 'true' and not slider_changed:
+        return no_update, "データ取得停止中", no_update
 
-    # 統計情報
-    if len(lidar_data['distances']) > 0:
-        avg_dist = np.mean(list(lidar_data['distances']))
-        min_dist = np.min(list(lidar_data['distances']))
-        max_dist = np.max(list(lidar_data['distances']))
+    # データをコピー（ロックはコピーの間だけ保持）
+    with data_lock:
+        version = lidar_data['version']
+        # 前回の描画から新しいデータがなければ何もしない
+        if version == last_version and not slider_changed:
+            return no_update, no_update, no_update
+        dist_by_bin = lidar_data['dist_by_bin'].copy()
+        # 直前の回転以降に有効な点が届いていないビンは消えた物体として扱う
+        stale = lidar_data['bin_revolution'] < lidar_data['revolution'] - 1
+    dist_by_bin[stale] = np.inf
+    valid = np.isfinite(dist_by_bin)
+    num_points = np.count_nonzero(valid)
+
+    # 角度ビン単位で点数を絞る（UIで設定された点数に基づく）
+    selected = select_bins(dist_by_bin, max_points)
+    distances = dist_by_bin[selected]
+
+    # 3D座標に変換（三角関数はテーブル参照）
+    x = distances * COS_LUT[selected]
+    y = distances * SIN_LUT[selected]
+    use_gl = max_points <= GL_MAX_POINTS
+    if slider_changed:
+        # 点数の変更時は表示方式（2D/3D）が変わり得るためグラフ全体を作り直す
+        fig = create_figure(use_gl)
+    else:
+        # 点群データのみを差分更新（レイアウトとカメラ位置はそのまま）
+        fig = Patch()
+    fig['data'][0]['x'] = x.tolist()
+    fig['data'][0]['y'] = y.tolist()
+    fig['data'][0]['marker']['color'] = distances.tolist()
+
+    # 統計情報（コピー済みの配列から計算）
+    if num_points > 0:
+        valid_distances = dist_by_bin[valid]
+        min_dist = valid_distances.min()
+        max_dist = valid_distances.max()
+        avg_dist = valid_distances.sum(dtype=np.float64) / num_points
         stats = html.Div([
-            html.P(f"ポイント数: {len(lidar_data['distances'])}", style={'margin': '5px 0'}),
+            html.P(f"ポイント数: {num_points}", style={'margin': '5px 0'}),
             html.P(f"平均距離: {avg_dist:.0f} mm", style={'margin': '5px 0'}),
             html.P(f"最小距離: {min_dist:.0f} mm", style={'margin': '5px 0'}),
             html.P(f"最大距離: {max_dist:.0f} mm", style={'margin': '5px 0'})
@@ -339,7 +485,10 @@ def update_graph(n, max_points, current_figure, stopped, relayout_data):
     else:
         stats = html.Div("データ待機中...")
 
-    return fig, stats
+    if stopped == 'true':
+        stats = "データ取得停止中"
+
+    return fig, stats, version
 
 
 def main():
@@ -369,9 +518,13 @@ def main():
 
         # Webサーバーを起動
         print("\nブラウザで http://127.0.0.1:8050 を開いてください")
-        print("マウスでドラッグ: 回転")
-        print("マウスホイール: ズーム")
-        print("右クリック+ドラッグ: パン")
+        print(f"プロット点数 {GL_MAX_POINTS} 以下: 上から見た2D表示")
+        print("  マウスでドラッグ: 範囲を拡大")
+        print("  ダブルクリック: 表示範囲を戻す")
+        print(f"プロット点数 {GL_MAX_POINTS} 超: 3D表示")
+        print("  マウスでドラッグ: 回転")
+        print("  マウスホイール: ズーム")
+        print("  右クリック+ドラッグ: パン")
         print("Ctrl+Cで終了")
 
         # Dashアプリを実行